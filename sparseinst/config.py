@@ -13,6 +13,11 @@ def add_sparse_inst_config(cfg):
     cfg.MODEL.SPARSE_INST.CLS_THRESHOLD = 0.005
     cfg.MODEL.SPARSE_INST.MASK_THRESHOLD = 0.45
     cfg.MODEL.SPARSE_INST.MAX_DETECTIONS = 100
+    # torch.compile the backbone, encoder and decoder for inference, compiled
+    # with dynamic shapes since test images are padded to varying sizes
+    cfg.MODEL.SPARSE_INST.COMPILE = False
+    # FP16 (autocast) backbone, encoder and decoder for inference
+    cfg.MODEL.SPARSE_INST.FP16_INFER = False
 
     # [Encoder]
     cfg.MODEL.SPARSE_INST.ENCODER = CN()
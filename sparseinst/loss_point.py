@@ -88,7 +88,7 @@ def compute_pairwise_term(mask_logits, pairwise_size, pairwise_dilation):
     log_fg_prob = F.logsigmoid(mask_logits)
     log_bg_prob = F.logsigmoid(-mask_logits)
 
-    from sparseinst.sparseinst import unfold_wo_center
+    from sparseinst.sparseinst_point import unfold_wo_center
     log_fg_prob_unfold = unfold_wo_center(
         log_fg_prob, kernel_size=pairwise_size,
         dilation=pairwise_dilation
@@ -1,13 +1,14 @@
 # Copyright (c) Tianheng Cheng and its affiliates. All Rights Reserved
 
+from typing import List, Tuple
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.cuda.amp import autocast
 
-from detectron2.modeling import build_backbone
 from detectron2.structures import ImageList, Instances, BitMasks
 from detectron2.modeling import META_ARCH_REGISTRY, build_backbone
-from skimage import color
 
 from .encoder import build_sparse_inst_encoder
 from .decoder import build_sparse_inst_decoder
@@ -23,49 +24,72 @@ def unfold_wo_center(x, kernel_size, dilation):
 
     # using SAME padding
     padding = (kernel_size + (dilation - 1) * (kernel_size - 1)) // 2
-    unfolded_x = F.unfold(
-        x, kernel_size=kernel_size,
-        padding=padding,
-        dilation=dilation
-    )
-
-    unfolded_x = unfolded_x.reshape(
-        x.size(0), x.size(1), -1, x.size(2), x.size(3)
-    )
-
-    # remove the center pixels
-    size = kernel_size ** 2
-    unfolded_x = torch.cat((
-        unfolded_x[:, :, :size // 2],
-        unfolded_x[:, :, size // 2 + 1:]
-    ), dim=2)
+    padded_x = F.pad(x, [padding, padding, padding, padding])
+    H, W = x.size(2), x.size(3)
+
+    # gather the shifted views of all neighbors, except the center pixels
+    center = kernel_size // 2
+    unfolded_x = torch.stack([
+        padded_x[:, :, i * dilation:i * dilation + H, j * dilation:j * dilation + W]
+        for i in range(kernel_size) for j in range(kernel_size)
+        if i != center or j != center
+    ], dim=2)
 
     return unfolded_x
 
 
-def get_images_color_similarity(images, image_masks, kernel_size, dilation):
+@torch.jit.script
+def get_images_color_similarity(images, image_masks, offsets: List[Tuple[int, int]], padding: int):
     assert images.dim() == 4
-    assert images.size(0) == 1
+    assert images.size(0) == image_masks.size(0)
+    H, W = images.size(2), images.size(3)
 
-    unfolded_images = unfold_wo_center(
-        images, kernel_size=kernel_size, dilation=dilation
-    )
+    # visit the neighbors (at `offsets` in the padded images) one shifted view
+    # at a time instead of materializing the unfolded images and masks
+    padded_images = F.pad(images, [padding, padding, padding, padding])
+    padded_masks = F.pad(image_masks, [padding, padding, padding, padding])
 
-    diff = images[:, :, None] - unfolded_images
-    similarity = torch.exp(-torch.norm(diff, dim=1) * 0.5)
+    similarity = images.new_empty((images.size(0), len(offsets), H, W))
+    for k in range(len(offsets)):
+        y, x = offsets[k]
+        diff = ((images - padded_images[:, :, y:y + H, x:x + W]) ** 2).sum(1)
+        similarity[:, k] = torch.exp(-torch.sqrt(diff) * 0.5) * padded_masks[:, y:y + H, x:x + W]
 
-    unfolded_weights = unfold_wo_center(
-        image_masks[None, None], kernel_size=kernel_size,
-        dilation=dilation
-    )[:,0]
-    # unfolded_weights = torch.max(unfolded_weights, dim=1)[0]
+    return similarity
+
+
+@torch.jit.script
+def rgb_to_lab(images, xyz_from_rgb):
+    """
+    Convert a batch of 8-bit RGB images (Bx3xHxW, values in [0, 255]) to
+    CIE-LAB (D65), matching `skimage.color.rgb2lab` but staying on device.
+    `xyz_from_rgb` is the 3x3 sRGB -> XYZ matrix normalized by the D65 white.
+    """
+    rgb = images.float() / 255.0
+    rgb = torch.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = torch.einsum('bchw,kc->bkhw', rgb, xyz_from_rgb)
+    xyz = torch.where(xyz > 0.008856, xyz.clamp(min=0.0) ** (1.0 / 3.0), 7.787 * xyz + 16.0 / 116.0)
+    x, y, z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    L = 116.0 * y - 16.0
+    a = 500.0 * (x - y)
+    b = 200.0 * (y - z)
+    return torch.stack([L, a, b], dim=1)
+
+
+def run_network(backbone, encoder, decoder, images):
+    features = backbone(images.contiguous(memory_format=torch.channels_last))
+    features = encoder(features)
+    output = decoder(features)
+    return output
 
-    return similarity * unfolded_weights
 
 @torch.jit.script
 def rescoring_mask(scores, mask_pred, masks):
-    mask_pred_ = mask_pred.float()
-    return scores * ((masks * mask_pred_).sum([1, 2]) / (mask_pred_.sum([1, 2]) + 1e-6))
+    mask_pred_ = mask_pred.to(masks.dtype)
+    # reduce the product directly, without the NxHxW intermediate
+    num = torch.einsum('nhw,nhw->n', masks, mask_pred_)
+    den = mask_pred_.sum([1, 2]) + 1e-6
+    return scores * (num / den)
 
 
 @META_ARCH_REGISTRY.register()
@@ -74,11 +98,9 @@ class SparseInst(nn.Module):
     def __init__(self, cfg):
         super().__init__()
 
-        # move to target device
-        self.device = torch.device(cfg.MODEL.DEVICE)
-
         # backbone
-        self.backbone = build_backbone(cfg)
+        # NHWC (channels_last) weights let cuDNN pick faster, Tensor Core kernels
+        self.backbone = build_backbone(cfg).to(memory_format=torch.channels_last)
         self.size_divisibility = self.backbone.size_divisibility
         output_shape = self.backbone.output_shape()
 
@@ -93,33 +115,74 @@ class SparseInst(nn.Module):
         # data and preprocessing
         self.mask_format = cfg.INPUT.MASK_FORMAT
 
-        self.pixel_mean = torch.Tensor(
-            cfg.MODEL.PIXEL_MEAN).to(self.device).view(3, 1, 1)
-        self.pixel_std = torch.Tensor(
-            cfg.MODEL.PIXEL_STD).to(self.device).view(3, 1, 1)
-        # self.normalizer = lambda x: (x - pixel_mean) / pixel_std
+        # buffers follow the model across devices, the model is moved to
+        # cfg.MODEL.DEVICE by build_model
+        self.register_buffer("pixel_mean", torch.Tensor(
+            cfg.MODEL.PIXEL_MEAN).view(1, 3, 1, 1), False)
+        self.register_buffer("pixel_std", torch.Tensor(
+            cfg.MODEL.PIXEL_STD).view(1, 3, 1, 1), False)
 
         # inference
         self.cls_threshold = cfg.MODEL.SPARSE_INST.CLS_THRESHOLD
         self.mask_threshold = cfg.MODEL.SPARSE_INST.MASK_THRESHOLD
         self.max_detections = cfg.MODEL.SPARSE_INST.MAX_DETECTIONS
+        # run backbone, encoder and decoder in FP16 for inference
+        self.fp16_infer = cfg.MODEL.SPARSE_INST.FP16_INFER
+        # compile backbone, encoder and decoder for inference (PyTorch >= 2.0),
+        # the compiled function takes the modules as inputs and does not hold
+        # on to this model, so deep copies run their own weights
+        self.compiled_network = None
+        if cfg.MODEL.SPARSE_INST.COMPILE:
+            if not hasattr(torch, "compile"):
+                raise RuntimeError(
+                    "MODEL.SPARSE_INST.COMPILE requires PyTorch >= 2.0 (torch.compile), "
+                    "found PyTorch {}".format(torch.__version__))
+            self.compiled_network = torch.compile(run_network, dynamic=True)
 
         # for pairwise loss
+        # sRGB -> XYZ matrix with the D65 reference white folded in (rgb_to_lab)
+        xyz_from_rgb = torch.Tensor([[0.412453, 0.357580, 0.180423],
+                                     [0.212671, 0.715160, 0.072169],
+                                     [0.019334, 0.119193, 0.950227]])
+        ref_white = torch.Tensor([0.95047, 1., 1.08883])
+        self.register_buffer("xyz_from_rgb", xyz_from_rgb / ref_white[:, None], False)
         self.pairwise_size = 3
         self.pairwise_dilation = 2
-
-    def normalizer(self, image):
-        image = (image - self.pixel_mean) / self.pixel_std
-        return image
+        # SAME padding and neighbor offsets (without the center) in the padded images
+        self.pairwise_padding = (self.pairwise_size + (self.pairwise_dilation - 1) *
+                                 (self.pairwise_size - 1)) // 2
+        center = self.pairwise_size // 2
+        self.pairwise_offsets = [
+            (i * self.pairwise_dilation, j * self.pairwise_dilation)
+            for i in range(self.pairwise_size) for j in range(self.pairwise_size)
+            if i != center or j != center
+        ]
+
+    @property
+    def device(self):
+        return self.pixel_mean.device
+
+    def normalizer(self, images):
+        images = (images - self.pixel_mean) / self.pixel_std
+        return images
 
     def preprocess_inputs(self, batched_inputs):
-        images = [x["image"].to(self.device) for x in batched_inputs]
-        # original_image_masks = [torch.ones_like(x[0], dtype=torch.float32) for x in images]
-        images = [self.normalizer(x) for x in images]
-        images = ImageList.from_tensors(images, 32)
-        # original_image_masks = ImageList.from_tensors(
-        #     original_image_masks, 32)
-        return images
+        images = [x["image"].to(self.device, non_blocking=True) for x in batched_inputs]
+        original_images = ImageList.from_tensors(images, 32)
+        # normalize the padded batch at once, the unnormalized batch is kept
+        # for the box-supervised losses
+        # valid (non-padded) pixels of each image in the padded batch
+        H, W = original_images.tensor.shape[-2:]
+        image_sizes = torch.as_tensor(original_images.image_sizes, device=self.device)
+        ys = torch.arange(H, device=self.device)[None, :, None]
+        xs = torch.arange(W, device=self.device)[None, None, :]
+        image_masks = (ys < image_sizes[:, 0, None, None]) & (xs < image_sizes[:, 1, None, None])
+        # keep the padding at 0 after normalization, the instance branch of
+        # the decoder aggregates over all locations, padding included
+        images = ImageList(
+            self.normalizer(original_images.tensor).mul_(image_masks[:, None]),
+            original_images.image_sizes)
+        return images, original_images, image_masks
 
     def prepare_targets(self, targets):
         new_targets = []
@@ -142,76 +205,43 @@ class SparseInst(nn.Module):
             #                 gt_masks.polygons, h, w)
             gt_box = targets_per_image.gt_boxes
             target["boxes"] = gt_box.to(self.device)
-            per_im_boxes = gt_box
-            per_im_bitmasks_full = []
-            for per_box in per_im_boxes:
-                bitmask_full = torch.zeros((h, w), device=self.device).float()
-                bitmask_full[int(per_box[1]):int(per_box[3] + 1), int(per_box[0]):int(per_box[2] + 1)] = 1.0
-
-                per_im_bitmasks_full.append(bitmask_full)  # 由bbox生成伪mask
-
-            gt_masks = torch.stack(per_im_bitmasks_full, dim=0)
+            # pseudo masks from boxes, built for all boxes at once
+            x1, y1, x2, y2 = gt_box.tensor.to(self.device).long().unbind(1)
+            x1, x2 = x1.clamp(0, w), x2.clamp(0, w)
+            y1, y2 = y1.clamp(0, h), y2.clamp(0, h)
+            ys = torch.arange(h, device=self.device)[None, :, None]
+            xs = torch.arange(w, device=self.device)[None, None, :]
+            gt_masks = ((ys >= y1[:, None, None]) & (ys <= y2[:, None, None]) &
+                        (xs >= x1[:, None, None]) & (xs <= x2[:, None, None]))
+            # already bool, so BitMasks wraps it without a cast
             target["masks"] = BitMasks(gt_masks)
             new_targets.append(target)
 
         return new_targets
 
-
-    def prepare_targets(self, targets):
-        new_targets = []
-        for targets_per_image in targets:
-            target = {}
-            gt_classes = targets_per_image.gt_classes
-            gt_color_similarity = targets_per_image.image_color_similarity
-            target["color_sim"] = gt_color_similarity.to(self.device)
-            target["labels"] = gt_classes.to(self.device)
-            h, w = targets_per_image.image_size
-            # if not targets_per_image.has('gt_masks'):
-            #     gt_masks = BitMasks(torch.empty(0, h, w))
-            # else:
-            #     gt_masks = targets_per_image.gt_masks
-            #     if self.mask_format == "polygon":
-            #         if len(gt_masks.polygons) == 0:
-            #             gt_masks = BitMasks(torch.empty(0, h, w))
-            #         else:
-            #             gt_masks = BitMasks.from_polygon_masks(
-            #                 gt_masks.polygons, h, w)
-            gt_box = targets_per_image.gt_boxes
-            target["boxes"] = gt_box.to(self.device)
-            per_im_boxes = gt_box
-            per_im_bitmasks_full = []
-            for per_box in per_im_boxes:
-                bitmask_full = torch.zeros((h, w), device=self.device).float()
-                bitmask_full[int(per_box[1]):int(per_box[3] + 1), int(per_box[0]):int(per_box[2] + 1)] = 1.0
-
-                per_im_bitmasks_full.append(bitmask_full)  # 由bbox生成伪mask
-
-            gt_masks = torch.stack(per_im_bitmasks_full, dim=0)
-            target["masks"] = BitMasks(gt_masks)
-            new_targets.append(target)
-
-        return new_targets
+    def forward_network(self, images):
+        network = run_network
+        if not self.training and self.compiled_network is not None:
+            network = self.compiled_network
+        return network(self.backbone, self.encoder, self.decoder, images)
 
     def forward(self, batched_inputs):
-        images = self.preprocess_inputs(batched_inputs)
+        images, original_images, image_masks = self.preprocess_inputs(batched_inputs)
         if isinstance(images, (list, torch.Tensor)):
             images = nested_tensor_from_tensor_list(images)
         max_shape = images.tensor.shape[2:]
         # forward
-        features = self.backbone(images.tensor)
-        features = self.encoder(features)
-        output = self.decoder(features)
+        if not self.training and self.fp16_infer:
+            with autocast():
+                output = self.forward_network(images.tensor)
+        else:
+            output = self.forward_network(images.tensor)
 
         if self.training:
             gt_instances = [x["instances"].to(
                 self.device) for x in batched_inputs]
-            original_images = [x["image"].to(self.device) for x in batched_inputs]
-            original_images = ImageList.from_tensors(original_images, 32)
-            original_image_masks = [torch.ones_like(x[0], dtype=torch.float32) for x in original_images]
-            original_image_masks = ImageList.from_tensors(
-                original_image_masks, 32)
             self.add_bitmasks_from_boxes(
-                gt_instances, original_images.tensor, original_image_masks.tensor,
+                gt_instances, original_images.tensor, image_masks.float(),
                 original_images.tensor.size(-2), original_images.tensor.size(-1)
             )
             targets = self.prepare_targets(gt_instances)
@@ -227,10 +257,12 @@ class SparseInst(nn.Module):
         # for inference, onnx, tensorrt
         # input images: BxCxHxW, fixed, need padding size
         # normalize
-        images = (images - self.pixel_mean[None]) / self.pixel_std[None]
-        features = self.backbone(images)
-        features = self.encoder(features)
-        output = self.decoder(features)
+        images = self.normalizer(images)
+        if self.fp16_infer:
+            with autocast():
+                output = run_network(self.backbone, self.encoder, self.decoder, images)
+        else:
+            output = run_network(self.backbone, self.encoder, self.decoder, images)
 
         pred_scores = output["pred_logits"].sigmoid()
         pred_masks = output["pred_masks"].sigmoid()
@@ -243,42 +275,48 @@ class SparseInst(nn.Module):
     def inference(self, output, batched_inputs, max_shape, image_sizes):
         # max_detections = self.max_detections
         results = []
-        pred_scores = output["pred_logits"].sigmoid()
-        pred_masks = output["pred_masks"].sigmoid()
-        pred_objectness = output["pred_scores"].sigmoid()
+        # back to float32 (no-op without FP16_INFER): the mask sums in
+        # rescoring_mask are neither exact nor bounded in fp16
+        pred_scores = output["pred_logits"].float().sigmoid()
+        pred_masks = output["pred_masks"].float().sigmoid()
+        pred_objectness = output["pred_scores"].float().sigmoid()
         pred_scores = torch.sqrt(pred_scores * pred_objectness)
 
-        for _, (scores_per_image, mask_pred_per_image, batched_input, img_shape) in enumerate(zip(
-                pred_scores, pred_masks, batched_inputs, image_sizes)):
+        # max/argmax and cls threshold over the whole batch
+        scores, labels = pred_scores.max(dim=-1)
+        keep = scores > self.cls_threshold
+        num_keep = keep.sum(dim=1).tolist()
+        scores = scores[keep]
+        labels = labels[keep]
+        pred_masks = pred_masks[keep]
+
+        # rescoring mask using maskness
+        scores = rescoring_mask(
+            scores, pred_masks > self.mask_threshold, pred_masks)
+
+        mask_h, mask_w = pred_masks.shape[-2:]
+        for scores_per_image, labels_per_image, mask_pred_per_image, batched_input, img_shape in zip(
+                scores.split(num_keep), labels.split(num_keep), pred_masks.split(num_keep),
+                batched_inputs, image_sizes):
 
             ori_shape = (batched_input["height"], batched_input["width"])
             result = Instances(ori_shape)
-            # max/argmax
-            scores, labels = scores_per_image.max(dim=-1)
-            # cls threshold
-            keep = scores > self.cls_threshold
-            scores = scores[keep]
-            labels = labels[keep]
-            mask_pred_per_image = mask_pred_per_image[keep]
-
-            if scores.size(0) == 0:
-                result.scores = scores
-                result.pred_classes = labels
+
+            if scores_per_image.size(0) == 0:
+                result.scores = scores_per_image
+                result.pred_classes = labels_per_image
                 results.append(result)
                 continue
 
             h, w = img_shape
-            # rescoring mask using maskness
-            scores = rescoring_mask(
-                scores, mask_pred_per_image > self.mask_threshold, mask_pred_per_image)
-
             # upsample the masks to the original resolution:
-            # (1) upsampling the masks to the padded inputs, remove the padding area
+            # (1) remove the padding area at the mask resolution
             # (2) upsampling/downsampling the masks to the original sizes
+            h_low = int(round(h * mask_h / max_shape[0]))
+            w_low = int(round(w * mask_w / max_shape[1]))
             mask_pred_per_image = F.interpolate(
-                mask_pred_per_image.unsqueeze(1), size=max_shape, mode="bilinear", align_corners=False)[:, :, :h, :w]
-            mask_pred_per_image = F.interpolate(
-                mask_pred_per_image, size=ori_shape, mode='bilinear', align_corners=False).squeeze(1)
+                mask_pred_per_image[:, None, :h_low, :w_low], size=ori_shape,
+                mode='bilinear', align_corners=False).squeeze(1)
 
             mask_pred = mask_pred_per_image > self.mask_threshold
             # fix the bug for visualization
@@ -286,8 +324,8 @@ class SparseInst(nn.Module):
 
             # using Detectron2 Instances to store the final results
             result.pred_masks = mask_pred
-            result.scores = scores
-            result.pred_classes = labels
+            result.scores = scores_per_image
+            result.pred_classes = labels_per_image
             results.append(result)
 
         return results
@@ -305,17 +343,16 @@ class SparseInst(nn.Module):
         )
         image_masks = image_masks[:, start::stride, start::stride]
 
-        for im_i, per_im_gt_inst in enumerate(instances):
-            images_lab = color.rgb2lab(downsampled_images[im_i].byte().permute(1, 2, 0).cpu().numpy())  # 图像色彩空间变换
-            images_lab = torch.as_tensor(images_lab, device=downsampled_images.device, dtype=torch.float32)
-            images_lab = images_lab.permute(2, 0, 1)[None]
-            images_color_similarity = get_images_color_similarity(
-                images_lab, image_masks[im_i],
-                self.pairwise_size, self.pairwise_dilation
-            )  # BoxInst
+        images_lab = rgb_to_lab(downsampled_images.byte(), self.xyz_from_rgb)  # 图像色彩空间变换
+
+        images_color_similarity = get_images_color_similarity(
+            images_lab, image_masks,
+            self.pairwise_offsets, self.pairwise_padding
+        )  # BoxInst
 
+        for im_i, per_im_gt_inst in enumerate(instances):
             if len(per_im_gt_inst) > 0:
-                per_im_gt_inst.image_color_similarity = torch.cat([
-                    images_color_similarity for _ in range(len(per_im_gt_inst))
-                ], dim=0)  # color sim
+                # identical for every instance, share it through a stride-0 view
+                per_im_gt_inst.image_color_similarity = images_color_similarity[im_i:im_i + 1].expand(
+                    len(per_im_gt_inst), -1, -1, -1)  # color sim
 